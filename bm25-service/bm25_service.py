@@ -4,12 +4,20 @@ BM25S Ultrafast Indexing Service for AutoLlama
 Provides BM25 text indexing capabilities with 500x speedup using scipy sparse matrices
 """
 
+import asyncio
 import bm25s
+import Stemmer
 import numpy as np
 import json
+import orjson
 import os
-import pickle
-from typing import List, Dict, Any, Optional
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import uvicorn
@@ -26,6 +34,37 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# English stemming shared by corpus and query tokenization so both map to the same vocabulary.
+# PyStemmer instances keep internal state and must not be used from several threads at once,
+# so each worker thread gets its own; every instance produces identical stems
+_thread_local = threading.local()
+
+def _get_stemmer() -> Stemmer.Stemmer:
+    """Get the calling thread's English stemmer"""
+    stemmer = getattr(_thread_local, "stemmer", None)
+    if stemmer is None:
+        stemmer = _thread_local.stemmer = Stemmer.Stemmer("english")
+    return stemmer
+
+@lru_cache(maxsize=2048)
+def _tokenize_query(query: str) -> Tuple[str, ...]:
+    """Tokenize a search query into stemmed tokens (memoized, popular queries repeat)"""
+    return tuple(bm25s.tokenize(query, stopwords="en", stemmer=_get_stemmer(), return_ids=False, show_progress=False)[0])
+
+def _dump_metadata(metadata: Dict) -> bytes:
+    """Serialize index metadata, falling back to stdlib json for values orjson rejects"""
+    try:
+        return orjson.dumps(metadata)
+    except TypeError:
+        # e.g. integers outside the 64-bit range; the indented form marks the file for json.loads
+        return json.dumps(metadata, indent=2).encode("utf-8")
+
+def _load_metadata(data: bytes) -> Dict:
+    """Deserialize index metadata written by _dump_metadata"""
+    if data.startswith(b"{\n"):
+        return json.loads(data)
+    return orjson.loads(data)
+
 class ChunkData(BaseModel):
     id: str
     text: str
@@ -41,16 +80,52 @@ class SearchRequest(BaseModel):
     filename: str
     top_k: int = 10
 
+class SearchBatchRequest(BaseModel):
+    query: str
+    filenames: List[str]
+    top_k: int = 10
+
 class BM25Manager:
-    def __init__(self, storage_path: str = "/tmp/bm25_indices"):
+    def __init__(self, storage_path: str = "/tmp/bm25_indices", max_live_indices: int = 32):
         self.storage_path = storage_path
-        self.indices: Dict[str, Any] = {}  # filename -> BM25 index
+        if max_live_indices < 1:
+            logger.warning(f"max_live_indices={max_live_indices} is invalid, keeping 1 index in memory")
+        self.max_live_indices = max(1, max_live_indices)  # at least the index being searched must stay resident
+        self.indices: "OrderedDict[str, Any]" = OrderedDict()  # filename -> BM25 index, least recently used first
         self.metadata: Dict[str, Dict] = {}  # filename -> index metadata
+        self._unpersisted: set = set()  # filenames whose index failed to save; never evicted
         os.makedirs(storage_path, exist_ok=True)
+        self._cleanup_interrupted_writes()
         logger.info(f"BM25Manager initialized with storage at: {storage_path}")
     
-    def _get_index_path(self, filename: str) -> str:
-        """Get the file path for storing a BM25 index"""
+    def _cleanup_interrupted_writes(self) -> None:
+        """Remove staging leftovers and restore retired indices from an interrupted _write_index_files"""
+        with os.scandir(self.storage_path) as entries:
+            leftovers = [entry.path for entry in entries if entry.name.startswith((".staging-", ".retired-"))]
+        
+        for path in leftovers:
+            try:
+                if os.path.basename(path).startswith(".retired-") and os.path.isdir(path):
+                    # A retired index whose replacement never landed is still the live one
+                    for name in os.listdir(path):
+                        index_dir = os.path.join(self.storage_path, name)
+                        if not os.path.exists(index_dir):
+                            os.replace(os.path.join(path, name), index_dir)
+                            logger.warning(f"Restored BM25 index after interrupted write: {index_dir}")
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except Exception as e:
+                logger.warning(f"Failed to clean up {path}: {str(e)}")
+    
+    def _get_index_dir(self, filename: str) -> str:
+        """Get the directory for storing a BM25 index (bm25s native format)"""
+        safe_filename = filename.replace("/", "_").replace("\\", "_")
+        return os.path.join(self.storage_path, f"{safe_filename}.bm25s")
+    
+    def _get_legacy_index_path(self, filename: str) -> str:
+        """Get the file path of a pre-bm25s-format pickled index (no longer loaded)"""
         safe_filename = filename.replace("/", "_").replace("\\", "_")
         return os.path.join(self.storage_path, f"{safe_filename}.bm25")
     
@@ -59,13 +134,54 @@ class BM25Manager:
         safe_filename = filename.replace("/", "_").replace("\\", "_")
         return os.path.join(self.storage_path, f"{safe_filename}.meta")
     
+    def _touch(self, filename: str) -> None:
+        """Mark an index as most recently used"""
+        self.indices.move_to_end(filename)
+    
+    def _store(self, filename: str, retriever: Any, metadata: Dict, persisted: bool = True) -> None:
+        """Keep an index in memory, evicting the least recently used beyond max_live_indices"""
+        self.indices[filename] = retriever
+        self.metadata[filename] = metadata
+        self._touch(filename)
+        if persisted:
+            self._unpersisted.discard(filename)
+        else:
+            self._unpersisted.add(filename)
+        
+        # Evicted indices stay on disk and are lazy-loaded on the next search; indices that
+        # could not be saved only exist in memory, so they are never evicted
+        evictable = [name for name in self.indices if name != filename and name not in self._unpersisted]
+        for evicted in evictable[:max(0, len(self.indices) - self.max_live_indices)]:
+            del self.indices[evicted]
+            self.metadata.pop(evicted, None)
+            logger.info(f"Evicted BM25 index from memory: {evicted}")
+    
+    def _build_retriever(self, corpus: List[str]) -> Any:
+        """Tokenize and index a corpus (CPU-bound, run off the event loop)"""
+        # Tokenize corpus for BM25S
+        logger.info("Tokenizing corpus...")
+        corpus_tokens = bm25s.tokenize(corpus, stopwords="en", stemmer=_get_stemmer(), show_progress=False)
+        
+        # Create BM25 retriever and index the corpus
+        logger.info("Indexing corpus...")
+        retriever = bm25s.BM25()
+        retriever.index(corpus_tokens, show_progress=False)
+        return retriever
+    
+    def _retrieve(self, retriever: Any, query: str, k: int):
+        """Tokenize a query and retrieve the top-k rows (CPU-bound, run off the event loop)"""
+        query_tokens = [list(_tokenize_query(query))]
+        # retrieve() returns (documents, scores); without a stored corpus the documents are row indices
+        return retriever.retrieve(query_tokens, k=k, show_progress=False)
+    
     async def create_index(self, chunks: List[ChunkData], filename: str, replace_existing: bool = True) -> Dict[str, Any]:
         """Create BM25 index from chunks using ultrafast bm25s library"""
         try:
-            start_time = datetime.now()
+            start_time = time.perf_counter()
+            created_at = datetime.now().isoformat()
             
             # Check if index exists and replace_existing is False
-            if not replace_existing and filename in self.indices:
+            if not replace_existing and (filename in self.indices or os.path.isdir(self._get_index_dir(filename))):
                 return {
                     "status": "exists",
                     "filename": filename,
@@ -80,36 +196,24 @@ class BM25Manager:
             chunk_ids = [chunk.id for chunk in chunks]
             chunk_metadata = [chunk.metadata for chunk in chunks]
             
-            # Tokenize corpus for BM25S
-            logger.info("Tokenizing corpus...")
-            corpus_tokens = bm25s.tokenize(corpus)
-            
-            # Create and train BM25 retriever
-            logger.info("Creating BM25 retriever...")
-            retriever = bm25s.BM25(corpus=corpus_tokens)
-            
-            # Index the corpus
-            logger.info("Indexing corpus...")
-            retriever.index(corpus_tokens)
-            
-            # Store in memory
-            self.indices[filename] = retriever
+            # Tokenize and index in a worker thread so other requests keep being served
+            retriever = await asyncio.to_thread(self._build_retriever, corpus)
             
-            # Store metadata
+            # Build metadata
             index_metadata = {
                 "filename": filename,
                 "chunk_count": len(chunks),
                 "chunk_ids": chunk_ids,
                 "chunk_metadata": chunk_metadata,
-                "created_at": start_time.isoformat(),
+                "created_at": created_at,
                 "corpus_size": len(corpus)
             }
-            self.metadata[filename] = index_metadata
             
-            # Persist to disk
-            await self._save_index_to_disk(filename, retriever, index_metadata)
+            # Persist to disk before making the index evictable
+            persisted = await self._save_index_to_disk(filename, retriever, index_metadata)
+            self._store(filename, retriever, index_metadata, persisted=persisted)
             
-            processing_time = (datetime.now() - start_time).total_seconds()
+            processing_time = time.perf_counter() - start_time
             
             logger.info(f"BM25 index created for {filename} in {processing_time:.2f}s")
             
@@ -119,7 +223,7 @@ class BM25Manager:
                 "chunks": len(chunks),
                 "processing_time_seconds": processing_time,
                 "index_size_mb": self._estimate_index_size(retriever),
-                "created_at": start_time.isoformat()
+                "created_at": created_at
             }
             
         except Exception as e:
@@ -129,7 +233,9 @@ class BM25Manager:
     async def search_index(self, query: str, filename: str, top_k: int = 10) -> Dict[str, Any]:
         """Search BM25 index for relevant chunks"""
         try:
-            if filename not in self.indices:
+            if filename in self.indices:
+                self._touch(filename)
+            else:
                 # Try to load from disk
                 await self._load_index_from_disk(filename)
                 
@@ -139,11 +245,9 @@ class BM25Manager:
             retriever = self.indices[filename]
             metadata = self.metadata[filename]
             
-            # Tokenize query
-            query_tokens = bm25s.tokenize([query])
-            
             # Search index
-            scores, indices = retriever.retrieve(query_tokens, k=top_k)
+            k = min(top_k, len(metadata["chunk_ids"]))
+            indices, scores = await asyncio.to_thread(self._retrieve, retriever, query, k)
             
             # Format results
             results = []
@@ -164,50 +268,129 @@ class BM25Manager:
                 "total_results": len(results)
             }
             
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Failed to search index for {filename}: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
     
-    async def _save_index_to_disk(self, filename: str, retriever: Any, metadata: Dict) -> None:
+    async def search_indices(self, query: str, filenames: List[str], top_k: int = 10) -> Dict[str, Any]:
+        """Search several BM25 indices concurrently, one worker thread per index
+        
+        A failing file does not fail the batch; it gets an error entry in `searches`.
+        """
+        outcomes = await asyncio.gather(
+            *[self.search_index(query, filename, top_k) for filename in filenames],
+            return_exceptions=True
+        )
+        
+        searches = []
+        for filename, outcome in zip(filenames, outcomes):
+            if isinstance(outcome, Exception):
+                searches.append({
+                    "filename": filename,
+                    "status": "error",
+                    "status_code": getattr(outcome, "status_code", 500),
+                    "detail": getattr(outcome, "detail", str(outcome))
+                })
+            elif isinstance(outcome, BaseException):
+                raise outcome  # cancellation, not a per-file failure
+            else:
+                searches.append(outcome)
+        
+        failed = sum(1 for search in searches if search["status"] == "error")
+        return {
+            "status": "success" if failed == 0 else "partial",
+            "query": query,
+            "searches": searches,
+            "failed": failed,
+            "total_results": sum(search.get("total_results", 0) for search in searches)
+        }
+    
+    def _write_index_files(self, filename: str, retriever: Any, metadata: Dict) -> str:
+        """Write BM25 index and metadata files (blocking I/O)"""
+        index_dir = self._get_index_dir(filename)
+        metadata_path = self._get_metadata_path(filename)
+        
+        # Serialize metadata up front so a failure leaves the existing index untouched
+        metadata_bytes = _dump_metadata(metadata)
+        
+        # Save score matrix, vocab and params as .npy/.json files into a fresh
+        # directory and swap it in; loaded retrievers memory-map the old files,
+        # so those must be unlinked rather than truncated in place
+        staging_dir = tempfile.mkdtemp(dir=self.storage_path, prefix=".staging-")
+        try:
+            retriever.save(staging_dir)
+            if os.path.isdir(index_dir):
+                retired_dir = tempfile.mkdtemp(dir=self.storage_path, prefix=".retired-")
+                retired_index = os.path.join(retired_dir, os.path.basename(index_dir))
+                try:
+                    os.replace(index_dir, retired_index)
+                    try:
+                        os.replace(staging_dir, index_dir)
+                    except Exception:
+                        # Put the previous index back so the existing .meta still matches it
+                        os.replace(retired_index, index_dir)
+                        raise
+                finally:
+                    shutil.rmtree(retired_dir, ignore_errors=True)
+            else:
+                os.replace(staging_dir, index_dir)
+        finally:
+            if os.path.isdir(staging_dir):
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        
+        # Save metadata via a temp file renamed into place so a failure never leaves a truncated file
+        fd, tmp_path = tempfile.mkstemp(dir=self.storage_path, prefix=".staging-", suffix=".meta")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(metadata_bytes)
+            os.replace(tmp_path, metadata_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        
+        return index_dir
+    
+    def _read_index_files(self, filename: str) -> Optional[tuple]:
+        """Read BM25 index and metadata files (blocking I/O), or None if missing"""
+        index_dir = self._get_index_dir(filename)
+        metadata_path = self._get_metadata_path(filename)
+        
+        if not os.path.isdir(index_dir) or not os.path.exists(metadata_path):
+            return None
+        
+        # Memory-map the score arrays so pages are read on demand
+        retriever = bm25s.BM25.load(index_dir, mmap=True)
+        
+        # Load metadata
+        with open(metadata_path, 'rb') as f:
+            metadata = _load_metadata(f.read())
+        
+        return retriever, metadata
+    
+    async def _save_index_to_disk(self, filename: str, retriever: Any, metadata: Dict) -> bool:
         """Save BM25 index and metadata to disk for persistence"""
         try:
-            index_path = self._get_index_path(filename)
-            metadata_path = self._get_metadata_path(filename)
-            
-            # Save retriever object
-            with open(index_path, 'wb') as f:
-                pickle.dump(retriever, f)
-            
-            # Save metadata
-            with open(metadata_path, 'w') as f:
-                json.dump(metadata, f, indent=2)
-                
-            logger.info(f"Saved BM25 index to disk: {index_path}")
+            index_dir = await asyncio.to_thread(self._write_index_files, filename, retriever, metadata)
+            logger.info(f"Saved BM25 index to disk: {index_dir}")
+            return True
             
         except Exception as e:
             logger.warning(f"Failed to save index to disk: {str(e)}")
+            return False
     
     async def _load_index_from_disk(self, filename: str) -> bool:
         """Load BM25 index and metadata from disk"""
         try:
-            index_path = self._get_index_path(filename)
-            metadata_path = self._get_metadata_path(filename)
-            
-            if not os.path.exists(index_path) or not os.path.exists(metadata_path):
+            loaded = await asyncio.to_thread(self._read_index_files, filename)
+            if loaded is None:
                 return False
             
-            # Load retriever object
-            with open(index_path, 'rb') as f:
-                retriever = pickle.load(f)
-            
-            # Load metadata
-            with open(metadata_path, 'r') as f:
-                metadata = json.load(f)
-            
-            self.indices[filename] = retriever
-            self.metadata[filename] = metadata
+            retriever, metadata = loaded
+            self._store(filename, retriever, metadata)
             
-            logger.info(f"Loaded BM25 index from disk: {index_path}")
+            logger.info(f"Loaded BM25 index from disk: {self._get_index_dir(filename)}")
             return True
             
         except Exception as e:
@@ -217,15 +400,32 @@ class BM25Manager:
     def _estimate_index_size(self, retriever: Any) -> float:
         """Estimate index size in MB"""
         try:
-            # Rough estimation based on corpus size
-            return len(str(retriever)) / (1024 * 1024)
+            # bm25s keeps the score matrix as raw CSC arrays in a dict
+            if not hasattr(retriever, "scores"):
+                return 0.0
+            scores = retriever.scores
+            size = scores["data"].nbytes + scores["indices"].nbytes + scores["indptr"].nbytes
+            return size / (1024 * 1024)
         except:
             return 0.0
     
+    def _count_indices_on_disk(self) -> int:
+        """Count persisted indices, including ones not currently loaded"""
+        with os.scandir(self.storage_path) as entries:
+            return sum(
+                1 for entry in entries
+                if entry.is_dir() and entry.name.endswith(".bm25s") and not entry.name.startswith(".")
+            )
+    
     def get_stats(self) -> Dict[str, Any]:
-        """Get statistics about all indices"""
+        """Get statistics about indices
+        
+        `total_indices` and `indices` cover indices resident in memory only; evicted
+        indices are still searchable and are counted in `indices_on_disk`.
+        """
         stats = {
             "total_indices": len(self.indices),
+            "indices_on_disk": self._count_indices_on_disk(),
             "indices": {}
         }
         
@@ -239,7 +439,7 @@ class BM25Manager:
         return stats
 
 # Global BM25 manager instance
-bm25_manager = BM25Manager()
+bm25_manager = BM25Manager(max_live_indices=int(os.environ.get("BM25_MAX_LIVE_INDICES", 32)))
 
 @app.post("/index/{filename}")
 async def create_index(filename: str, request: IndexRequest):
@@ -259,6 +459,15 @@ async def search_index(filename: str, request: SearchRequest):
         top_k=request.top_k
     )
 
+@app.post("/search_batch")
+async def search_batch(request: SearchBatchRequest):
+    """Search multiple files' BM25 indices in parallel"""
+    return await bm25_manager.search_indices(
+        query=request.query,
+        filenames=request.filenames,
+        top_k=request.top_k
+    )
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -271,7 +480,7 @@ async def health_check():
 
 @app.get("/stats")
 async def get_stats():
-    """Get statistics about all indices"""
+    """Get statistics about resident indices, plus the number of indices persisted on disk"""
     return bm25_manager.get_stats()
 
 @app.delete("/index/{filename}")
@@ -284,12 +493,17 @@ async def delete_index(filename: str):
         if filename in bm25_manager.metadata:
             del bm25_manager.metadata[filename]
         
+        bm25_manager._unpersisted.discard(filename)
+        
         # Remove from disk
-        index_path = bm25_manager._get_index_path(filename)
+        index_dir = bm25_manager._get_index_dir(filename)
+        legacy_index_path = bm25_manager._get_legacy_index_path(filename)
         metadata_path = bm25_manager._get_metadata_path(filename)
         
-        if os.path.exists(index_path):
-            os.remove(index_path)
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        if os.path.isfile(legacy_index_path):
+            os.remove(legacy_index_path)
         if os.path.exists(metadata_path):
             os.remove(metadata_path)
         